@@ -1,22 +1,42 @@
+from functools import cache
 from pathlib import Path
-from profiles import FileProfileRepository, ProfileRepository
-from rich.console import Console
-from host_service import create_os_host_service
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from rich.console import Console
+    from profiles import ProfileRepository
+    from host_service import PlatformHostService
 
 APP_NAME = "mc-manager"
 
 
+@cache
 def get_app_dir() -> Path:
     return Path(f"~/{APP_NAME}").expanduser().resolve()
 
 
-def create_user_profile_repo() -> ProfileRepository:
-    path = get_app_dir().joinpath("profiles")
-    path.mkdir(parents=True, exist_ok=True)
-    return FileProfileRepository(path)
+def create_user_profile_repo() -> "ProfileRepository":
+    from profiles import FileProfileRepository
+    return FileProfileRepository(get_app_dir().joinpath("profiles"))
+
+
+# Heavy dependencies (yaml, pydantic, rich, screen detection) are only
+# built on first access, so `mcm --version` doesn't pay for them.
+@cache
+def get_profile_repository() -> "ProfileRepository":
+    return create_user_profile_repo()
+
+
+@cache
+def get_server_service() -> "PlatformHostService":
+    from host_service import create_os_host_service
+    return create_os_host_service()
+
+
+@cache
+def get_console() -> "Console":
+    from rich.console import Console
+    return Console()
 
 
 __version__ = "0.0.1"
-profile_repository = create_user_profile_repo()
-server_service = create_os_host_service()
-console = Console()
\ No newline at end of file
@@ -1,12 +1,32 @@
+import importlib
 import typer
-import cli.server
-import cli.profile
 from typing import Annotated
+from click import Command, Context
+from typer.core import TyperGroup
 from cli.config import __version__
 
-app = typer.Typer()
-app.add_typer(cli.profile.app, name="profile")
-app.add_typer(cli.server.app, name="server")
+
+class LazyTyperGroup(TyperGroup):
+    # Sub-apps are imported only when their command is actually dispatched
+    lazy_subcommands: dict[str, str] = {
+        "profile": "cli.profile",
+        "server": "cli.server",
+    }
+
+    def list_commands(self, ctx: Context) -> list[str]:
+        return [*super().list_commands(ctx), *self.lazy_subcommands]
+
+    def get_command(self, ctx: Context, cmd_name: str) -> Command | None:
+        module_name = self.lazy_subcommands.get(cmd_name)
+        if module_name is None:
+            return super().get_command(ctx, cmd_name)
+        module = importlib.import_module(module_name)
+        command = typer.main.get_command(module.app)
+        command.name = cmd_name
+        return command
+
+
+app = typer.Typer(cls=LazyTyperGroup)
 
 
 def version_callback(value: bool):
@@ -1,13 +1,13 @@
-from profiles import Profile, ProfileNotFoundError
-import yaml
+from profiles import Profile, ProfileNotFoundError, dump_yaml
 import typer
 from pathlib import Path
-from typing import Annotated, Any, Final
-from cli.config import get_app_dir, profile_repository, console
+from typing import Annotated, Any, Final, List
+from cli.config import get_app_dir, get_console, get_profile_repository
 from click import ParamType
+from rich.console import Group, RenderableType
 from rich.table import Table
 from rich.text import Text
-from utils import fallback, random_craft_name, resolve_value
+from utils import fallback, random_craft_name, resolve_value, sanitize_filename
 
 
 app = typer.Typer()
@@ -15,12 +15,12 @@ app = typer.Typer()
 
 def profile_to_string(profile: Profile) -> str:
     # Just serialize as yaml, this is fine for printing
-    return yaml.safe_dump(profile.as_dict(), sort_keys=False)
+    return dump_yaml(profile.as_dict())
 
 
 def profile_to_table(profile: Profile) -> Table:
     table = Table(show_header=False)
-    for key, value in profile.as_dict().items():
+    for key, value in profile.view().items():
         table.add_row(key, str(value))
     return table
 
@@ -28,8 +28,8 @@ def profile_to_table(profile: Profile) -> Table:
 
 def typer_load_profile(name: str) -> Profile:
     try:
-        return profile_repository.load(name)
-    except Exception:
+        return get_profile_repository().load(name)
+    except ProfileNotFoundError:
         typer.echo(f"The server profile '{name}' does not exist")
         raise typer.Abort()
     
@@ -43,9 +43,9 @@ class ClickProfileParser(ParamType):
 
 def prompt_unique_name(name: str | None) -> str:
     if name == None:
-        name = str(typer.prompt("Profile name"))
+        name = typer.prompt("Profile name")
 
-    if profile_repository.exists(name):
+    if get_profile_repository().exists(name):
         overwrite = typer.confirm(f"Profile with name {name} already exists, overwrite?")
         if not overwrite:
             raise typer.BadParameter(f"Profile with name '{name}' already exists.")
@@ -54,47 +54,44 @@ def prompt_unique_name(name: str | None) -> str:
 
 
 def prompt_dir(name: str, value: str | None) -> Path:
-    path: Path | None = None
-    while path is None:
-        if value is None or not value.strip():
-            value = str(typer.prompt(f"Please enter the {name}"))
+    while True:
+        while value is None or not value.strip():
+            value = typer.prompt(f"Please enter the {name}")
 
         try:
-            path = Path(value).expanduser()
-            try:
-                path = path.resolve()
-            except FileNotFoundError:
-                path = path.absolute()
+            # Absolute like Profile stores it, symlinks are kept as given
+            path = Path(value).expanduser().absolute()
         except Exception as e:
             typer.echo(f"Invalid path: {e}")
             value = None
-            path = None
             continue
 
-        if not path.exists():
-            if not typer.confirm(f"The directory {path} does not exist. Use anyway?"):
-                value = None
-                path = None
-    return path
+        if path.exists() or typer.confirm(f"The directory {path} does not exist. Use anyway?"):
+            return path
+        value = None
 
 
 def prompt_str(name: str, value: str | None) -> str:
     if value == None:
-        return str(typer.prompt(f"Enter the {name}"))
+        return typer.prompt(f"Enter the {name}")
     return value
 
 
 def generate_unique_random_name() -> str:
+    taken = get_profile_repository().slots()
     generated = random_craft_name()
-    while profile_repository.exists(generated):
+    while sanitize_filename(generated) in taken:
         generated = random_craft_name()
     return generated
 
 
 def make_unique(basename: str) -> str:
+    # One listing up front, then probe the names in memory. Names collide on
+    # the file they're saved to, e.g. "Server-1" would overwrite "server-1"
+    taken = get_profile_repository().slots()
     generated = basename
     suffix = 1
-    while profile_repository.exists(generated):
+    while sanitize_filename(generated) in taken:
         generated = f"{basename}-{suffix}"
         suffix += 1
     return generated
@@ -133,8 +130,9 @@ def create(
         )
     elif template:
         try:
-            template_profile = profile_repository.load(template)
-            template_profile.name = make_unique(template_profile.name)
+            template_profile = get_profile_repository().load(template)
+            # Copy, the repository may hand out shared cached instances
+            template_profile = template_profile.model_copy(update={"name": make_unique(template_profile.name)})
         except ProfileNotFoundError:
             raise typer.BadParameter(f"Profile template {template} does not exist")
     
@@ -158,14 +156,14 @@ def create(
         )
 
 
-    console.print("Creating the following profile:")
-    console.print(profile_to_table(new_profile))
+    get_console().print("Creating the following profile:")
+    get_console().print(profile_to_table(new_profile))
 
     confirm = typer.confirm("Is this OK?")
     if not confirm:
         raise typer.Abort()
 
-    location = profile_repository.save(new_profile.name, new_profile)
+    location = get_profile_repository().save(new_profile.name, new_profile)
     typer.echo(f"Saved new profile to {location}!")
 
 
@@ -177,20 +175,26 @@ def list(
     List all the profiles.
     """
 
-    list = profile_repository.list()
-    typer.echo(f"Listing {len(list)} profiles:")
+    list = get_profile_repository().list()
 
     if not verbose:
+        # Plain lines, so piped output is never reflowed to the terminal width
+        lines = [f"Listing {len(list)} profiles:"]
         for info in list:
             if info.profile != None:
-                typer.echo(f"* {info.profile.name} [{info.location}]")
+                lines.append(f"* {info.profile.name} [{info.location}]")
             else:
-                console.print(Text(f"* INVALID [{info.location}]", style="red"))
-    else:
-        for info in list:
-            if info.profile != None:
-                table = profile_to_table(info.profile)
-                typer.echo(f"* {info.profile.name} [{info.location}]")
-                console.print(table)
-            else:
-                console.print(Text(f"* INVALID [{info.location}]", style="red"))
\ No newline at end of file
+                lines.append(typer.style(f"* INVALID [{info.location}]", fg="red"))
+        typer.echo("\n".join(lines))
+        return
+
+    # Collect everything and write it out in one go
+    items: List[RenderableType] = [Text(f"Listing {len(list)} profiles:")]
+    for info in list:
+        if info.profile != None:
+            items.append(Text(f"* {info.profile.name} [{info.location}]"))
+            items.append(profile_to_table(info.profile))
+        else:
+            items.append(Text(f"* INVALID [{info.location}]", style="red"))
+
+    get_console().print(Group(*items), soft_wrap=True)
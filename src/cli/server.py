@@ -1,16 +1,34 @@
+import grp
+import gzip
+import io
+import os
+import pwd
+import shutil
+import stat
+import subprocess
 import tarfile
+import time
 import typer
-from cli.config import profile_repository, server_service
-from typing import Annotated, Any, Iterator
-from profiles import Profile
-from utils import generate_unique_path, sanitize_filename
+from cli.config import get_profile_repository, get_server_service
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cache
+from queue import Queue
+from threading import Thread
+from typing import Annotated, Any, BinaryIO, Callable, Deque, Iterable, Iterator, List, Literal, NamedTuple, Tuple
+from profiles import Profile, ProfileNotFoundError
+from utils import open_unique_file, sanitize_filename
 from pathlib import Path
-from datetime import datetime
-from click import ParamType
-from rich.progress import track, Progress, SpinnerColumn, TextColumn
+from click import Choice, ParamType
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, SpinnerColumn, TextColumn
 
 
 app = typer.Typer()
+Compression = Literal["gz", "zst"]
+COPY_BUFFER_SIZE = 1 << 20 # region files are multi-MB, tarfile defaults to 16 KiB reads
+WRITE_BUFFER_SIZE = 4 << 20 # coalesce the many 512 byte headers/paddings into large writes
+DEFAULT_COMPRESS_LEVEL = 3 # world data compresses well already at low levels, high levels mostly burn CPU
 
 
 class ProfileParser(ParamType):
@@ -19,14 +37,14 @@ class ProfileParser(ParamType):
     def convert(self, value: str, param: Any, ctx: Any):
         name = value
         try:
-            return profile_repository.load(name)
-        except Exception:
+            return get_profile_repository().load(name)
+        except ProfileNotFoundError:
             typer.echo(f"The server profile '{name}' does not exist")
             raise typer.Abort()
 
 
 def require_running(name: str):
-    if not server_service.is_server_running(name):
+    if not get_server_service().is_server_running(name):
         raise typer.BadParameter(f"Server {name} is not running")
 
 @app.command()
@@ -40,10 +58,10 @@ def start(
     workdir = profile.server_location
     entrypoint = profile.entrypoint
 
-    if server_service.is_server_running(name):
+    if get_server_service().is_server_running(name):
         raise typer.BadParameter(f"Server {name} is already running")
     
-    if server_service.start_server(name, workdir, entrypoint):
+    if get_server_service().start_server(name, workdir, entrypoint):
         typer.echo(f"Started server {name}")
     else:
         typer.echo("Could not start server")
@@ -58,7 +76,7 @@ def exec(
     """
     name = profile.name
     require_running(name)    
-    server_service.run_in_server(name, command)
+    get_server_service().run_in_server(name, command)
 
 
 @app.command()
@@ -71,7 +89,7 @@ def stop(
     name = profile.name
     require_running(name)
     typer.echo("Stopping server...")
-    if server_service.stop_server(name):
+    if get_server_service().stop_server(name):
         typer.echo(f"Stopped server {name}")
     else:
         typer.echo(f"Could not verify whether stop successful {name}")
@@ -82,7 +100,7 @@ def list():
     """
     List the running servers by name and host.
     """
-    running_servers = server_service.list_running()
+    running_servers = get_server_service().list_running()
     for server in running_servers:
         typer.echo(f"* {server.name} : {server.host_location}") 
 
@@ -91,15 +109,28 @@ def list():
 def backup(
     profile: Annotated[Profile, typer.Argument(help="The name of the profile.", click_type=ProfileParser())],
     progress: Annotated[bool, typer.Option(help="Show backup progress.")] = False,
-    world: Annotated[bool, typer.Option(help="Only backup the server world.")] = False
+    world: Annotated[bool, typer.Option(help="Only backup the server world.")] = False,
+    compression: Annotated[str | None, typer.Option(help="Archive compression, zst when zstd is installed, gz otherwise or with --index.", click_type=Choice(["gz", "zst"]))] = None,
+    level: Annotated[int, typer.Option(help="Compression level, lower is faster. 1-9 for gz, 1-19 for zst.", min=1, max=19)] = DEFAULT_COMPRESS_LEVEL,
+    index: Annotated[bool, typer.Option(help="Write a block index next to a gz backup, so it can be decompressed in parallel.")] = False,
 ):
     """
     Create a server backup based on the provided configuration.
     """
 
-    if server_service.is_server_running(profile.name):
+    if get_server_service().is_server_running(profile.name):
         raise typer.BadParameter("Cannot create backup of running server")
 
+    if compression is None:
+        # Only gz backups can be indexed, so asking for one picks gz
+        compression = "gz" if index else default_compression()
+    if compression == "zst" and not shutil.which("zstd"):
+        raise typer.BadParameter("zst compression requires zstd to be installed")
+    if compression == "gz" and level > 9:
+        raise typer.BadParameter("gz compression level must be between 1 and 9")
+    if index and compression != "gz":
+        raise typer.BadParameter("A block index can only be written for gz backups")
+
     backup_dir = Path(profile.backup_location)
     dir_to_backup = Path(profile.server_location)
     if world:
@@ -109,79 +140,327 @@ def backup(
         typer.echo(f"Cannot create backup, the directory '{dir_to_backup}' does not exist.")
         raise typer.Abort()
     
-    if not backup_dir.exists():
-        try:
-            backup_dir.mkdir(parents=True)
-            typer.echo(f"Created new backup directory at '{backup_dir}'")
-        except Exception:
-            typer.echo(f"Cannot create backup, the backup directory '{backup_dir}' cannot be accessed or created")
-            raise
+    try:
+        backup_dir.mkdir(parents=True)
+        typer.echo(f"Created new backup directory at '{backup_dir}'")
+    except FileExistsError:
+        pass
+    except Exception:
+        typer.echo(f"Cannot create backup, the backup directory '{backup_dir}' cannot be accessed or created")
+        raise
 
-    backup_file = generate_unique_path(
+    with open_unique_file(
         backup_dir,
         lambda: generate_backup_name(profile.name, world),
-        "tar.gz"
-    )
+        f"tar.{compression}"
+    ) as backup_file:
+        index_path = f"{backup_file.name}.idx" if index else None
+        create_backup(dir_to_backup, backup_file, compression, progress, level, index_path)
 
-    create_backup(dir_to_backup, backup_file, progress)
-
-    print(f"Successfully backed up '{profile.name}' to {backup_file}")
+    print(f"Successfully backed up '{profile.name}' to {backup_file.name}")
 
 
 def generate_backup_name(name: str, isWorldOnly: bool) -> str:
     name = sanitize_filename(name)
-    now = datetime.today()
-    timestamp = now.strftime('%Y-%m-%d')
+    timestamp = time.strftime('%Y-%m-%d')
     flag = "[world]" if isWorldOnly else "[server]"
     return f"{name} {timestamp} {flag}"
 
 
-def iter_files(path: Path) -> Iterator[Path]:
+def iter_files(path: Path) -> Iterator[tuple[str, os.stat_result]]:
     if path.is_file():
-        yield path
+        yield str(path), os.lstat(path)
     elif path.is_dir():
-        for p in path.rglob("*"):
-            if p.is_file():
-                yield p
+        # scandir entries carry the file type from the directory listing,
+        # so walking the tree needs no extra stat per entry
+        stack = [str(path)]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path, entry.stat(follow_symlinks=False)
     else:
         raise ValueError(f"{path} is not a file or directory")
 
 
-def create_tar(root: Path, output: Path) -> Iterator[Path]:
-    iterator = iter_files(root)
-    with tarfile.open(output, "w:gz") as tar:
-        if root.is_dir():
-            root_name = root.name
-            for file in iterator:
-                name = str(root_name / file.relative_to(root))
-                tar.add(file, arcname=name)
-                yield file
+@cache
+def user_name(uid: int) -> str:
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@cache
+def group_name(gid: int) -> str:
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+class ArchiveEntry(NamedTuple):
+    path: str
+    arcname: str
+    stat: os.stat_result
+
+
+def add_file(tar: tarfile.TarFile, entry: ArchiveEntry):
+    path, arcname, st = entry
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink > 1:
+        # e.g. symlinks, let tarfile work out the details, it also stores a second
+        # hardlink as a link instead of another copy. The walk already yields
+        # every file, so a directory must never be expanded again here
+        tar.add(path, arcname=arcname, recursive=False)
+        return
+
+    # Build the header from the stat we already have, tar.add would stat again
+    # and resolve the owner names for every single file
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mtime = st.st_mtime
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.uname = user_name(st.st_uid)
+    info.gname = group_name(st.st_gid)
+    with open(path, "rb") as file:
+        tar.addfile(info, file)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    # Compresses fixed size blocks as independent gzip members on a thread pool.
+    # Concatenated members are still one valid gzip stream, and zlib releases
+    # the GIL while compressing, so the blocks are compressed on all cores.
+    __output: BinaryIO
+    __level: int
+    __block_size: int
+    __buffer: bytearray
+    __pool: ThreadPoolExecutor
+    __pending: Deque[Tuple[int, "Future[bytes]"]]
+    __max_pending: int
+    __members: List[Tuple[int, int]]
+    __offsets: Tuple[int, int]
+
+    def __init__(self, output: BinaryIO, threads: int, level: int = DEFAULT_COMPRESS_LEVEL, block_size: int = 1 << 20):
+        super().__init__()
+        self.__output = output
+        self.__level = level
+        self.__block_size = block_size
+        self.__buffer = bytearray()
+        self.__pool = ThreadPoolExecutor(max_workers=threads)
+        self.__pending = deque()
+        self.__max_pending = 2 * threads # bounds memory when reading outpaces compression
+        self.__members = []
+        self.__offsets = (0, 0) # (uncompressed, compressed) offset of the next member
+
+
+    def writable(self) -> bool:
+        return True
+
+
+    @property
+    def members(self) -> List[Tuple[int, int]]:
+        # (uncompressed offset, compressed offset) at which each gzip member starts
+        return self.__members
+
+
+    def write(self, data: Any) -> int:
+        self.__buffer += data
+        while len(self.__buffer) >= self.__block_size:
+            self.__submit(bytes(self.__buffer[:self.__block_size]))
+            del self.__buffer[:self.__block_size]
+        return len(data)
+
+
+    def __submit(self, block: bytes):
+        self.__pending.append((len(block), self.__pool.submit(gzip.compress, block, self.__level, mtime=0)))
+        while len(self.__pending) >= self.__max_pending:
+            self.__write_member()
+
+
+    def __write_member(self):
+        size, future = self.__pending.popleft()
+        member = future.result()
+        self.__output.write(member)
+        self.__members.append(self.__offsets)
+        self.__offsets = (self.__offsets[0] + size, self.__offsets[1] + len(member))
+
+
+    def close(self):
+        if not self.closed:
+            if self.__buffer:
+                self.__submit(bytes(self.__buffer))
+                self.__buffer.clear()
+            while self.__pending:
+                self.__write_member()
+            self.__pool.shutdown()
+        super().close()
+
+
+def default_compression() -> Compression:
+    # zstd is multi-threaded and much cheaper per byte than single-threaded zlib
+    return "zst" if shutil.which("zstd") else "gz"
+
+
+def compress_threads() -> int:
+    # Anything that isn't a number counts as unset, at least one thread is needed
+    try:
+        threads = int(os.environ.get("MCM_COMPRESS_THREADS", ""))
+    except ValueError:
+        threads = os.cpu_count() or 1
+    return max(threads, 1)
+
+
+def compressor_command(compression: Compression, level: int) -> List[str] | None:
+    threads = str(compress_threads())
+    match compression:
+        case "zst":
+            return ["zstd", "-q", f"-{level}", "-c", f"-T{threads}"]
+        case "gz":
+            # pigz is a parallel drop-in for gzip, fall back to zlib without it
+            return ["pigz", f"-{level}", "-c", "-p", threads] if shutil.which("pigz") else None
+
+
+def write_block_index(path: str, members: Iterable[Tuple[int, int]]):
+    # One "<uncompressed offset> <compressed offset>" line per gzip member,
+    # each member decompresses on its own starting at its compressed offset
+    with open(path, "w") as file:
+        file.writelines(f"{uncompressed} {compressed}\n" for uncompressed, compressed in members)
+
+
+@contextmanager
+def open_compressed_tar(output: BinaryIO, compression: Compression, level: int, index_path: str | None = None) -> Iterator[tarfile.TarFile]:
+    if index_path is not None:
+        # Only our own writer knows where its member boundaries are, pigz's don't show in the output
+        with (
+            ParallelGzipWriter(output, compress_threads(), level) as writer,
+            tarfile.open(fileobj=writer, mode="w|", bufsize=WRITE_BUFFER_SIZE, copybufsize=COPY_BUFFER_SIZE) as tar,
+        ):
+            yield tar
+        write_block_index(index_path, writer.members)
+        return
+
+    command = compressor_command(compression, level)
+    if command is None:
+        threads = compress_threads()
+        if threads == 1:
+            # tarfile's own "w|gz" always compresses at level 9
+            with (
+                gzip.GzipFile(fileobj=output, mode="wb", compresslevel=level, mtime=0) as writer,
+                tarfile.open(fileobj=writer, mode="w|", bufsize=WRITE_BUFFER_SIZE, copybufsize=COPY_BUFFER_SIZE) as tar,
+            ):
+                yield tar
         else:
-            for file in iterator:
-                tar.add(file, arcname=file.name)
-                yield file
+            with (
+                ParallelGzipWriter(output, threads, level) as writer,
+                tarfile.open(fileobj=writer, mode="w|", bufsize=WRITE_BUFFER_SIZE, copybufsize=COPY_BUFFER_SIZE) as tar,
+            ):
+                yield tar
+        return
+
+    # Stream the uncompressed tar into the compressor, which uses all cores
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output)
+    assert proc.stdin is not None
+    try:
+        with tarfile.open(fileobj=proc.stdin, mode="w|", bufsize=WRITE_BUFFER_SIZE, copybufsize=COPY_BUFFER_SIZE) as tar:
+            yield tar
+    finally:
+        proc.stdin.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"{command[0]} exited with code {returncode}")
+
+
+def archive_entries(root: Path) -> Iterator[ArchiveEntry]:
+    if root.is_dir():
+        root_name = root.name
+        prefix_len = len(str(root))
+        for file, st in iter_files(root):
+            yield ArchiveEntry(file, root_name + file[prefix_len:], st)
+    else:
+        for file, st in iter_files(root):
+            yield ArchiveEntry(file, root.name, st)
+
+
+def walk_in_background(
+    entries: Iterable[ArchiveEntry],
+    on_done: Callable[[int], None] | None = None,
+    batch_size: int = 256,
+) -> Iterator[ArchiveEntry]:
+    # Walks the tree on its own thread so waiting on directory reads overlaps
+    # with compressing, on_done gets the file count once the walk finished
+    batches: "Queue[List[ArchiveEntry] | BaseException | None]" = Queue(maxsize=64)
+
+    def walk():
+        try:
+            count = 0
+            batch: List[ArchiveEntry] = []
+            for entry in entries:
+                batch.append(entry)
+                if len(batch) == batch_size:
+                    batches.put(batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                batches.put(batch)
+                count += len(batch)
+            if on_done is not None:
+                on_done(count)
+            batches.put(None)
+        except BaseException as e:
+            batches.put(e)
+
+    Thread(target=walk, daemon=True).start() # daemon, an aborted backup must not wait on it
+    while (batch := batches.get()) is not None:
+        if isinstance(batch, BaseException):
+            raise batch
+        yield from batch
+
+
+def write_tar(entries: Iterable[ArchiveEntry], output: BinaryIO, compression: Compression, level: int, index_path: str | None = None):
+    with open_compressed_tar(output, compression, level, index_path) as tar:
+        for entry in entries:
+            add_file(tar, entry)
+
+
+def create_tar(entries: Iterable[ArchiveEntry], output: BinaryIO, compression: Compression, level: int, index_path: str | None = None, batch_size: int = 64) -> Iterator[int]:
+    # Yields the number of files added since the last yield, once per batch
+    with open_compressed_tar(output, compression, level, index_path) as tar:
+        pending = 0
+        for entry in entries:
+            add_file(tar, entry)
+            pending += 1
+            if pending == batch_size:
+                yield pending
+                pending = 0
+        if pending:
+            yield pending
 
             
 def create_backup(
     dir: Path,
-    output: Path,
+    output: BinaryIO,
+    compression: Compression,
     show_progress: bool = False,
+    level: int = DEFAULT_COMPRESS_LEVEL,
+    index_path: str | None = None,
 ):
+    # Entries come straight from the one scandir walk, nothing is indexed up front
     if not show_progress:
-        for _ in create_tar(dir, output):
-            pass
+        write_tar(walk_in_background(archive_entries(dir)), output, compression, level, index_path)
     else:
+        # Total is unknown until the walk, which runs ahead of archiving, is done
         with Progress(
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            MofNCompleteColumn(),
             transient=True,
-        ) as spinner:
-            spinner.add_task(description="Indexing...")
-            files = [*iter_files(dir)]
-
-        for _ in track(
-            create_tar(dir, output),
-            total=len(files),
-            description="Archiving..."
-        ):
-            pass
\ No newline at end of file
+        ) as progress:
+            task = progress.add_task(description="Archiving...", total=None)
+            entries = walk_in_background(archive_entries(dir), lambda count: progress.update(task, total=count))
+            for added in create_tar(entries, output, compression, level, index_path):
+                progress.advance(task, added)
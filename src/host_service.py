@@ -1,15 +1,128 @@
 from dataclasses import dataclass
+import math
+import os
 import platform
+import pwd
+import re
+import select
+import shlex
 import shutil
+import stat
 import time
 import subprocess
 from subprocess import CompletedProcess
 from abc import ABC, abstractmethod
+from functools import cache
+from typing import NamedTuple, Sequence
 from utils import sanitize_filename
 
 
-def run(cmd: list[str]) -> CompletedProcess[str]:
-    return subprocess.run(cmd, capture_output=True, text=True)
+# Session lines look like "\t12345.name\t(Detached)", header and footer don't match
+_SESSION_LINE = re.compile(r"^\s+(\d+\.\S+)\s+\(", re.MULTILINE)
+# Footer, e.g. "1 Socket in /run/screen/S-user." or "No Sockets found in /run/screen/S-user."
+_SOCKET_DIR = re.compile(r"Sockets? (?:found )?in (.+)\.$", re.MULTILINE)
+# Every session has a socket named after it in the socket dir, "12345.name"
+_SESSION_SOCKET = re.compile(r"\d+\.\S+")
+# Anything a plain argv can't express, quotes are fine since shlex handles them
+_SHELL_SYNTAX = re.compile(r"[;&|<>$`()*?~{}\[\]#\\\n]|(^|\s)\w+=")
+
+
+def default_socket_dir() -> str | None:
+    # Where screen keeps its sockets unless built otherwise, None if neither exists.
+    # Screen names the dir after the real user, not $USER
+    try:
+        user = pwd.getpwuid(os.getuid()).pw_name
+    except KeyError:
+        return None # No passwd entry, e.g. in a container, screen -ls still knows
+    for candidate in (f"/run/screen/S-{user}", f"/tmp/screens/S-{user}"):
+        if os.path.isdir(candidate):
+            return candidate
+    return None
+
+
+def session_alive(socket_dir: str, session: str) -> bool:
+    try:
+        st = os.stat(os.path.join(socket_dir, session))
+    except OSError:
+        return False
+    if not (stat.S_ISSOCK(st.st_mode) or stat.S_ISFIFO(st.st_mode)):
+        return False # screen can be built to use named pipes
+
+    # The socket outlives a crashed session, the pid is its screen process
+    try:
+        os.kill(int(session.partition(".")[0]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # Alive, just not ours
+    return True
+
+
+def wait_for_exit(pids: list[int], timeout: float | None = None) -> bool | None:
+    # Sleeps until every process exited, the kernel wakes us through a pidfd per process.
+    # None when pidfds aren't available (not Linux, kernel older than 5.3)
+    fds: list[int] = []
+    try:
+        for pid in pids:
+            try:
+                fds.append(os.pidfd_open(pid))
+            except ProcessLookupError:
+                pass # Already gone
+    except (AttributeError, OSError):
+        for fd in fds:
+            os.close(fd)
+        return None
+
+    try:
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN) # readable once the process exited
+        deadline = None if timeout is None else time.monotonic() + timeout
+        remaining = len(fds)
+        while remaining:
+            wait_ms = None if deadline is None else max(0, (deadline - time.monotonic()) * 1000)
+            events = poller.poll(wait_ms)
+            if not events:
+                return False # Timed out
+            for fd, _ in events:
+                poller.unregister(fd)
+                remaining -= 1
+        return True
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+@cache
+def resolve_executable(name: str) -> str:
+    return shutil.which(name) or name
+
+
+def run(cmd: list[str], cwd: str | None = None, capture: bool = True) -> CompletedProcess[str]:
+    # Calls without a cwd (screen -ls, -X stuff) are spawned through posix_spawn instead
+    # of fork+exec, CPython only does that without close_fds and with an absolute path.
+    # create() needs a cwd and forks anyway, and its screen daemon outlives us,
+    # so fds we inherited from our own parent are closed for it
+    executable, *args = cmd
+    # Without capture there are no pipes to set up and drain, only the exit code is kept
+    output = subprocess.PIPE if capture else subprocess.DEVNULL
+    return subprocess.run(
+        [resolve_executable(executable), *args],
+        stdout=output, stderr=output, text=True, close_fds=cwd is not None, cwd=cwd
+    )
+
+
+def command_argv(command: str) -> list[str]:
+    # Simple commands run directly, only shell syntax needs bash in between
+    if not _SHELL_SYNTAX.search(command):
+        try:
+            argv = shlex.split(command)
+        except ValueError:
+            argv = [] # e.g. unbalanced quotes, let bash report it
+        # Builtins and keywords like exec, ulimit or time aren't programs screen can run
+        if argv and ("/" in argv[0] or shutil.which(argv[0]) is not None):
+            return argv
+    return ["bash", "-c", command]
 
 
 class ScreenService(ABC):
@@ -29,76 +142,151 @@ class ScreenService(ABC):
     def wait_term(self, name: str, poll_interval: float = 0.5, timeout: float | None = None) -> bool:
         ...
 
+    def bulk_stuff(self, name: str, commands: Sequence[str]) -> bool:
+        # Stuffed text is typed into the session as is, one line
+        # per command runs all of them with a single stuff
+        if not commands:
+            return True # An empty stuff would still type a newline
+        return self.stuff(name, "\n".join(commands))
+
     def exists(self, name: str) -> bool:
         return name in self.list(trim_id=True)
     
     def trim_id(self, name: str) -> str:
-        return name.split(".")[1] if "." in name else name
+        # Only the first dot separates the pid, session names may contain more
+        pid, dot, session = name.partition(".")
+        return session if dot and pid.isdigit() else name
+
+
+class SessionSnapshot(NamedTuple):
+    taken: float # time.monotonic()
+    sessions: list[str] # "12345.name"
+    by_name: dict[str, str] # "name" -> "12345.name"
 
 
 class LinuxScreenService(ScreenService):
+    __snapshot: SessionSnapshot | None
+    __snapshot_ttl: float
+    __socket_dir: str | None
+
+    def __init__(self, snapshot_ttl: float = 0.25):
+        self.__snapshot = None
+        self.__snapshot_ttl = snapshot_ttl
+        # Without any of these, the first screen -ls tells us
+        self.__socket_dir = os.environ.get("SCREENDIR") or default_socket_dir()
+
+
     def _normalize_name(self, name: str) -> str:
         # Just use the filename algo
         return sanitize_filename(name)
     
 
-    def list(self, trim_id: bool = False) -> list[str]:
+    def __get_snapshot(self) -> SessionSnapshot:
+        # A single command often checks the same sessions more than once,
+        # reuse the last listing for a moment instead of listing them again
+        now = time.monotonic()
+        if self.__snapshot is not None and now - self.__snapshot.taken < self.__snapshot_ttl:
+            return self.__snapshot
+
+        if self.__socket_dir is None:
+            sessions = self.__run_list() # Also tells us where the sockets live
+        else:
+            sessions = self.__scan_sockets(self.__socket_dir)
+        self.__snapshot = SessionSnapshot(now, sessions, {self.trim_id(session): session for session in sessions})
+        return self.__snapshot
+
+
+    def invalidate(self):
+        # Forget the last listing, e.g. after starting a session
+        self.__snapshot = None
+
+
+    def __run_list(self) -> list[str]:
         result = run(["screen", "-ls"])
-        lines = result.stdout.splitlines()
-        
-        if result.returncode != 0:
-            return [] # TODO: Error?
-
-        if len(lines) < 2:
-            return [] # TODO: Do we want to error this, or maybe just log
-        
-        session_names: list[str] = []
-
-        for line in lines[1:-1]: # Skip header and footer
-            line = line.strip()
-            if not line:
-                continue
-            parts = line.split()
-            name = parts[0] # "12345.name"
-            if trim_id:     # "12345.name" -> "name"
-                name = self.trim_id(name)
-            session_names.append(name)
-        
-        return session_names
+        socket_dir = _SOCKET_DIR.search(result.stdout)
+        if socket_dir is not None:
+            self.__socket_dir = socket_dir.group(1)
+        return _SESSION_LINE.findall(result.stdout) if result.returncode == 0 else []
+
+
+    def __scan_sockets(self, socket_dir: str) -> list[str]:
+        # Reading the socket dir is what screen -ls does, minus the fork+exec
+        try:
+            entries = os.scandir(socket_dir)
+        except FileNotFoundError:
+            return [] # Screen creates it with the first session
+        except OSError:
+            return self.__run_list() # e.g. not ours to read, screen -ls still knows
+        with entries:
+            return [
+                entry.name for entry in entries
+                if _SESSION_SOCKET.fullmatch(entry.name) and session_alive(socket_dir, entry.name)
+            ]
+
+
+    def list(self, trim_id: bool = False) -> list[str]:
+        snapshot = self.__get_snapshot()
+        if trim_id: # "12345.name" -> "name"
+            return [self.trim_id(session) for session in snapshot.sessions]
+        return snapshot.sessions.copy()
 
 
     def create(self, name: str, command: str, workdir: str | None = None) -> bool:
         name = self._normalize_name(name)
-        if workdir != None:
-            # If workdir provided cd to it first
-            command = f"cd {workdir} && {command}"
-        
-        args = ["screen", "-dmS", name, "bash", "-c", command]
-        result = run(args) # call subprocess
+        # The session starts in screen's working directory, no need for a cd
+        args = ["screen", "-dmS", name, *command_argv(command)]
+        try:
+            result = run(args, cwd=workdir, capture=False) # call subprocess
+        except OSError:
+            return False # e.g. the workdir doesn't exist
+        self.invalidate()
         return result.returncode == 0
 
 
     def stuff(self, name: str, command: str) -> bool:
         name = self._normalize_name(name)
-        result = run(["screen", "-S", name, "-X", "stuff", f"{command}\n"])
+        # The full "12345.name" id spares screen matching the name against every socket
+        session = self.__get_snapshot().by_name.get(name, name)
+        result = run(["screen", "-S", session, "-X", "stuff", f"{command}\n"], capture=False)
+        self.invalidate()
         return result.returncode == 0
 
 
     def wait_term(self, name: str, poll_interval: float = 0.5, timeout: float | None = None) -> bool:
         name = self._normalize_name(name)
-        start = time.monotonic()
+        sessions = [session for session in self.list() if self.trim_id(session) == name]
+
+        # The session id starts with the pid of its screen process
+        exited = wait_for_exit([int(session.partition(".")[0]) for session in sessions], timeout)
+        if exited is not None:
+            return exited
+
+        socket_dir = self.__socket_dir
+
+        # Only the sessions we're waiting for need checking, not the whole listing
+        def running() -> bool:
+            if socket_dir is None:
+                return self.exists(name)
+            return any(session_alive(socket_dir, session) for session in sessions)
+
+        # Check often at first, a stop that is quick shouldn't wait out a full
+        # interval, then back off to poll_interval for slow ones
+        deadline = math.inf if timeout is None else time.monotonic() + timeout
+        interval = min(0.02, poll_interval)
         while True:
-            if not self.exists(name):
+            if not running():
                 return True
-            if timeout is not None and time.monotonic() - start > timeout:
+            now = time.monotonic()
+            if now >= deadline:
                 return False
-            time.sleep(poll_interval)
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * 2, poll_interval)
 
     def exists(self, name: str) -> bool:
-        return super().exists(self._normalize_name(name))
+        return self._normalize_name(name) in self.__get_snapshot().by_name
 
 
-@dataclass
+@dataclass(slots=True)
 class HostDescriptor():
     name: str
     host_location: str
@@ -117,39 +305,47 @@ class PlatformHostService(ABC):
     def stop_server(self, name: str) -> bool:
         ...
 
+    def stop_servers(self, names: list[str]) -> dict[str, bool]:
+        return {name: self.stop_server(name) for name in names}
+
     @abstractmethod
     def list_running(self) -> list[HostDescriptor]:
         ...
     
     @abstractmethod
-    def run_in_server(self, name: str, command: str):
+    def run_in_server(self, name: str, command: str | Sequence[str]):
         ...
 
 
+STOP_TIMEOUT = 10 # seconds a server gets to save and shut down
+
+
 class ScreenPlatformService(PlatformHostService):
     __prefix: str
+    __local_prefix: str
     __screen: ScreenService
 
     def __init__(self, screen: ScreenService):
         self.__prefix = "mcm"
+        self.__local_prefix = f"{self.__prefix}-"
         self.__screen = screen
 
 
     def __to_local_name(self, base: str) -> str:
-        return f"{self.__prefix}-{base}"
+        return self.__local_prefix + base
     
 
     def __strip_local_name(self, base: str) -> str:
-        split = len(self.__prefix) + 1 # +1 for dash
-        return base[split:]
+        return base[len(self.__local_prefix):]
     
     
-    def __list_local_sessions(self) -> list[str]:
-        result: list[str] = []
+    def __list_local_sessions(self) -> list[tuple[str, str]]:
+        # (session id, server name) of every session started by us
+        result: list[tuple[str, str]] = []
         for session in self.__screen.list():
             name = self.__screen.trim_id(session)
-            if name.startswith(self.__prefix):
-                result.append(session)
+            if name.startswith(self.__local_prefix):
+                result.append((session, self.__strip_local_name(name)))
         return result
     
 
@@ -166,19 +362,33 @@ class ScreenPlatformService(PlatformHostService):
     def stop_server(self, name: str) -> bool:
         local_name = self.__to_local_name(name)
         self.__screen.stuff(local_name, "stop")
-        return self.__screen.wait_term(local_name, 1, 10)
+        return self.__screen.wait_term(local_name, 1, STOP_TIMEOUT)
+
+
+    def stop_servers(self, names: list[str]) -> dict[str, bool]:
+        # Tell every server to stop first so they shut down side by side,
+        # the waits then share one deadline instead of adding up
+        local_names = [self.__to_local_name(name) for name in names]
+        for local_name in local_names:
+            self.__screen.stuff(local_name, "stop")
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        return {
+            name: self.__screen.wait_term(local_name, 1, max(0, deadline - time.monotonic()))
+            for name, local_name in zip(names, local_names)
+        }
     
     
     def list_running(self) -> list[HostDescriptor]:
-        return [HostDescriptor(
-            self.__strip_local_name(self.__screen.trim_id(session)),
-            f"screen@{session}"
-        ) for session in self.__list_local_sessions()]
+        return [HostDescriptor(name, f"screen@{session}") for session, name in self.__list_local_sessions()]
     
 
-    def run_in_server(self, name: str, command: str):
+    def run_in_server(self, name: str, command: str | Sequence[str]):
         local_name = self.__to_local_name(name)
-        self.__screen.stuff(local_name, command)
+        if isinstance(command, str):
+            self.__screen.stuff(local_name, command)
+        else:
+            self.__screen.bulk_stuff(local_name, command)
 
 
 def create_os_host_service() -> PlatformHostService:
@@ -1,10 +1,14 @@
+import json
+import os
+import stat
+import time
 from abc import ABC
-from pydantic import AfterValidator, BaseModel, ValidationError
-import yaml
-from typing import Annotated, Any, Callable, List
-from pathlib import Path
-from dataclasses import dataclass, fields
+from pydantic import AfterValidator, BaseModel, ConfigDict, ValidationError
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Annotated, Any, Callable, Iterator, List, Mapping
 from pathlib import Path
+from dataclasses import dataclass
 from utils import sanitize_filename
 
 
@@ -12,12 +16,17 @@ def parse_path(path: str | None) -> Path:
     if path is None:
         raise ValueError("path cannot be None")
     try:
-        return Path(path).expanduser().resolve()
+        # Absolute, but symlinks are kept, resolving them walks the filesystem and
+        # nothing needs the real path, the OS follows the links when it's used
+        return Path(path).expanduser().absolute()
     except Exception:
         raise ValueError(f"path {path} cannot resolved")
 
 
 class Profile(BaseModel):
+    # Loaded profiles are cached and shared between callers, use model_copy(update=...) to change one
+    model_config = ConfigDict(frozen=True)
+
     name: str
     server_location: Annotated[Path, AfterValidator(parse_path)]
     backup_location: Annotated[Path, AfterValidator(parse_path)]
@@ -29,6 +38,11 @@ class Profile(BaseModel):
         # json mode normalizes values to primitive types
         # e.g. Path -> str
         return self.model_dump(mode="json")
+
+
+    def view(self) -> Mapping[str, Any]:
+        # Read-only live view of the field values, nothing is copied
+        return MappingProxyType(self.__dict__)
     
 
 class TypeNotSupportedError(Exception):
@@ -41,12 +55,25 @@ class ParseError(Exception):
         super().__init__("Cannot parse data")
 
 
+# Only legacy .yml profiles and dump_yaml use yaml, so it's imported on first use.
+# Prefer the libyaml bindings, PyYAML can be built without them
+def parse_yaml(data: str | bytes) -> dict[str, Any]:
+    import yaml
+    return yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def dump_yaml(data: Any) -> str:
+    import yaml
+    return yaml.dump(data, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), sort_keys=False)
+
+
 class DynamicParser:
-    Parser = Callable[[str], dict[str, Any]]
+    Parser = Callable[[bytes], dict[str, Any]]
 
     __parsers: dict[str, Parser] = {
-        "yml": yaml.safe_load,
-        "yaml": yaml.safe_load,
+        "json": json.loads,
+        "yml": parse_yaml,
+        "yaml": parse_yaml,
     }
 
     def __get_parser(self, typename: str) -> Parser:
@@ -60,7 +87,12 @@ class DynamicParser:
         return typename in self.__parsers
 
 
-    def parse(self, typename: str, data: str) -> dict[str, Any]:
+    def parsers(self) -> Mapping[str, Parser]:
+        # Read-only extension -> parser table, for callers that dispatch themselves
+        return MappingProxyType(self.__parsers)
+
+
+    def parse(self, typename: str, data: bytes) -> dict[str, Any]:
         parser = self.__get_parser(typename)
         try:
             return parser(data)
@@ -69,7 +101,7 @@ class DynamicParser:
 
 
 
-@dataclass
+@dataclass(slots=True)
 class ProfileInfo:
     location: str
     profile: Profile | None
@@ -91,6 +123,9 @@ class ProfileRepository(ABC):
     def exists(self, name: str) -> bool:
         ...
 
+    def slots(self) -> set[str]:
+        ...
+
 
 class ProfileNotFoundError(Exception):
     def __init__(self, name: str):
@@ -103,90 +138,242 @@ def try_safe_cast(data: Any) -> Profile | None:
     if not isinstance(data, dict):
         return None
     try:
-        config_fields = {f.name for f in fields(Profile)}
-        filtered_data: dict[str, Any] = {k: data[k] for k in config_fields if k in data}
-        return Profile(**filtered_data)
-    except (TypeError, ValueError):
+        # Unknown keys are ignored by pydantic, so the dict is validated as is without filtering it first
+        return Profile.model_validate(data)
+    except ValueError:
         return None
 
 
 class FileProfileRepository(ProfileRepository):
     __storage_dir: Path
-    __parser: DynamicParser
-
-    def __init__(self, path: Path):
-        if not path.exists() or not path.is_dir():
-            raise RuntimeError(f"Path {path} is not a directory or does not exist")
+    __storage_ready: bool
+    __parsers: Mapping[str, DynamicParser.Parser]
+    __cache: OrderedDict[str, tuple[int, int, Profile | None]]
+    __cache_size: int
+    __misses: dict[str, float]
+    __miss_ttl: float
+    __index: dict[str, str] | None
+
+    def __init__(self, path: Path, miss_ttl: float = 1.0, cache_size: int = 100):
+        # The directory is only created once something is saved,
+        # until then it just holds no profiles
         self.__storage_dir = Path(path)
-        self.__parser = DynamicParser()
+        self.__storage_ready = False
+        self.__parsers = DynamicParser().parsers() # Looked up per file, so bound once
+        self.__cache = OrderedDict() # path -> (mtime_ns, size, parsed profile), least recent first
+        self.__cache_size = cache_size
+        self.__misses = {} # name -> monotonic time of the failed lookup
+        self.__miss_ttl = miss_ttl
+        self.__index = None # profile name -> file name, read on first use
 
 
     def __scoped_name(self, name: str) -> str:
         return sanitize_filename(name)
 
 
-    def __scoped_path(self, name: str) -> Path:
-        return self.__storage_dir.joinpath(f"{name}.yml")
+    def __scoped_path(self, name: str, typename: str = "json") -> Path:
+        return self.__storage_dir.joinpath(f"{name}.{typename}")
     
     
-    def __try_load(self, path: Path) -> Profile | None:
-        if not path.is_file():
+    def __not_a_directory(self) -> RuntimeError:
+        return RuntimeError(f"Path {self.__storage_dir} is not a directory")
+
+
+    def __iter_profile_files(self) -> Iterator[os.DirEntry[str]]:
+        try:
+            entries = os.scandir(self.__storage_dir)
+        except FileNotFoundError:
+            return # Nothing saved yet
+        except NotADirectoryError as e:
+            raise self.__not_a_directory() from e
+        with entries:
+            for entry in entries:
+                typename = entry.name.rpartition(".")[2]
+                if typename in self.__parsers and entry.is_file():
+                    yield entry
+
+
+    def __try_load(self, path: Path, st: os.stat_result | None = None) -> Profile | None:
+        key = str(path)
+        try:
+            st = path.stat() if st is None else st
+        except OSError:
+            self.__cache.pop(key, None)
+            return None
+        if not stat.S_ISREG(st.st_mode):
             return None
+
+        # Only re-parse when the file changed since we last read it,
+        # broken files are remembered as None so they aren't parsed again either.
+        # The stat stays in front of the read, on a cache hit it's the only syscall
+        cached = self.__cache.get(key)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            self.__cache.move_to_end(key)
+            return cached[2]
+
+        profile = self.__parse(path)
+        self.__remember(key, st, profile)
+        return profile
+
+
+    def __remember(self, key: str, st: os.stat_result, profile: Profile | None):
+        self.__cache[key] = (st.st_mtime_ns, st.st_size, profile)
+        self.__cache.move_to_end(key)
+        if len(self.__cache) > self.__cache_size:
+            self.__cache.popitem(last=False)
+
+
+    def __parse(self, path: Path) -> Profile | None:
+        parser = self.__parsers.get(path.suffix[1:])
+        if parser is None:
+            return None # Unsupported type
+        try:
+            # Both json and yaml detect the encoding themselves, no need to decode first
+            read = path.read_bytes()
+        except OSError:
+            return None # Removed or replaced after the stat
+        try:
+            parsed = parser(read)
+        except Exception:
+            return None # Not valid json/yaml
         try:
-            read = path.read_text()
-            parsed = self.__parser.parse("yml", read)
             return Profile(**parsed)
-        except TypeNotSupportedError:
-            return None # Don't swallow this
-        except ParseError:
-            return None # Don't swallow this
-        except ValidationError:
-            return None # Don't swallow this
+        except (TypeError, ValidationError):
+            return None # Parsed, but not a profile
 
     
+    def __index_path(self) -> Path:
+        # Not a supported extension, so it's never listed as a profile
+        return self.__storage_dir.joinpath(".profile-index")
+
+
+    def __get_index(self) -> dict[str, str]:
+        # Remembers which file holds a profile whose name doesn't match its file name,
+        # only a hint, every hit is still checked against the loaded profile
+        if self.__index is None:
+            try:
+                self.__index = json.loads(self.__index_path().read_text())
+            except (OSError, ValueError):
+                self.__index = {}
+        return self.__index
+
+
+    def __save_index(self):
+        index_path = self.__index_path()
+        try:
+            temp_path = index_path.with_name(f"{index_path.name}.tmp")
+            temp_path.write_text(json.dumps(self.__get_index()))
+            temp_path.replace(index_path)
+        except OSError:
+            pass # Lookups fall back to scanning
+
+
     def __find_profile(self, query: str):
-        expected_path = self.__scoped_path(self.__scoped_name(query))
-        
-        # Try expected location
-        current = self.__try_load(expected_path)
+        scoped_name = self.__scoped_name(query)
+
+        json_path = self.__scoped_path(scoped_name)
+        current = self.__try_load(json_path)
         if current != None and current.name == query:
             return current # Profile found in expected file
+
+        # Older versions saved profiles as yaml, move it to json so it's only parsed once.
+        # Unless the json file is taken, e.g. by a profile whose name sanitizes the same
+        current = self.__try_load(self.__scoped_path(scoped_name, "yml"))
+        if current != None and current.name == query:
+            if not json_path.exists():
+                try:
+                    self.save(query, current)
+                except OSError:
+                    pass # Still usable, just not migrated
+            return current
         
+        index = self.__get_index()
+        indexed = index.get(query)
+        if indexed is not None:
+            current = self.__try_load(self.__storage_dir.joinpath(indexed))
+            if current != None and current.name == query:
+                return current # Profile found where we last saw it
+
         # Fishing in the dark... 
-        # iter all yml files in profile dir, and check if any match the provided name
-        for path in self.__storage_dir.glob("*.yml"):
-            current = self.__try_load(path)
+        # iter all profile files in profile dir, and check if any match the provided name
+        for entry in self.__iter_profile_files():
+            current = self.__try_load(Path(entry.path), entry.stat())
             if current != None and current.name == query:
+                index[query] = entry.name
+                self.__save_index()
                 return current # Profile found in different file
-            
+
+        if index.pop(query, None) is not None:
+            self.__save_index() # Stale
         return None # Profile not found
 
         
     def load(self, name: str) -> Profile:
+        # A name that just failed to load doesn't need another directory scan
+        missed = self.__misses.get(name)
+        if missed is not None and time.monotonic() - missed < self.__miss_ttl:
+            raise ProfileNotFoundError(name)
+
         loaded = self.__find_profile(name)
         if loaded != None:
             return loaded
         else:
+            self.__misses[name] = time.monotonic()
             raise ProfileNotFoundError(name)
         
 
     def save(self, name: str, config: Profile) -> str:
         name = self.__scoped_name(name)
-        path = self.__storage_dir.joinpath(f"{name}.yml")
-        serialized = yaml.safe_dump(config.as_dict(), sort_keys=False)
-
-        with open(path, 'w+') as file:
+        path = self.__scoped_path(name)
+        # Serialized straight from the model, without building a dict first
+        serialized = config.model_dump_json(indent=2)
+
+        if not self.__storage_ready:
+            try:
+                self.__storage_dir.mkdir(parents=True, exist_ok=True)
+            except FileExistsError as e:
+                raise self.__not_a_directory() from e
+            self.__storage_ready = True
+
+        with open(path, 'w+', encoding="utf-8") as file:
             file.write(serialized)
-
+            file.flush()
+            st = os.fstat(file.fileno())
+
+        # Seed the cache so loading what we just wrote doesn't re-parse it,
+        # profiles are frozen so the caller's instance can be shared as is
+        self.__remember(str(path), st, config)
+        self.__misses.clear()
+
+        # Profiles used to be stored as yaml, drop the stale copy. Only if it's this
+        # profile, another one whose name sanitizes the same may still live there
+        legacy_path = self.__scoped_path(name, "yml")
+        legacy = self.__try_load(legacy_path)
+        if legacy != None and legacy.name == config.name:
+            legacy_path.unlink(missing_ok=True)
         return str(path)
 
 
     def list(self) -> List[ProfileInfo]:
         return [
-            ProfileInfo(path.name, self.__try_load(path))
-            for path in self.__storage_dir.glob("*.yml")
+            ProfileInfo(entry.name, self.__try_load(Path(entry.path), entry.stat()))
+            for entry in self.__iter_profile_files()
         ]
 
 
     def exists(self, name: str) -> bool:
-        return self.__find_profile(name) != None
\ No newline at end of file
+        # Whether saving under this name would overwrite a file, nothing is parsed.
+        # Use load() to find a valid profile with this name
+        scoped_name = self.__scoped_name(name)
+        return any(self.__scoped_path(scoped_name, typename).is_file() for typename in ("json", "yml"))
+
+
+    def slots(self) -> set[str]:
+        # Sanitized names that are taken on disk, saving under any of them overwrites a file.
+        # Same files as exists() checks, read from one listing without parsing anything
+        slots: set[str] = set()
+        for entry in self.__iter_profile_files():
+            stem, _, typename = entry.name.rpartition(".")
+            if typename in ("json", "yml"):
+                slots.add(stem)
+        return slots
\ No newline at end of file
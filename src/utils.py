@@ -1,14 +1,17 @@
+from functools import lru_cache
 from pathlib import Path
 import random
 import re
-from typing import Callable, TypeVar
+from typing import BinaryIO, Callable, TypeVar
 
 
+_ILLEGAL_NAME_CHARS = re.compile(r'[<>:"/\\|?*\s]+')
+
+
+@lru_cache(maxsize=512) # the same few profile names are sanitized over and over
 def sanitize_filename(name: str) -> str:
-    illegals = r'[<>:"/\\|?*\s]+'
-    name = name.lower().strip(" ")     # lowercase & trim whitespace 
-    name = re.sub(illegals, "_", name) # collapse illegals chars into one underscore
-    return name
+    # lowercase & trim whitespace, then collapse illegal chars into one underscore
+    return _ILLEGAL_NAME_CHARS.sub("_", name.lower().strip())
 
 
 def sanitize_extension(extension: str | None) -> str:
@@ -25,16 +28,19 @@ def sanitize_extension(extension: str | None) -> str:
         return extension
     
 
-def generate_unique_path(root: Path, name_generator: Callable[[], str], extension: str) -> Path:
+def open_unique_file(root: Path, name_generator: Callable[[], str], extension: str) -> BinaryIO:
     base_name = name_generator()
     extension = sanitize_extension(extension)
 
     path = root.joinpath(f"{base_name}.{extension}")
     index = 1
-    while path.exists():
-        path = root.joinpath(f"{base_name}-{index}.{extension}")
-        index += 1
-    return path
+    while True:
+        try:
+            # "x" (O_CREAT | O_EXCL) claims the name in one syscall, no separate exists() probe
+            return open(path, "xb")
+        except FileExistsError:
+            path = root.joinpath(f"{base_name}-{index}.{extension}")
+            index += 1
 
 
 def random_craft_name(separator: str = "-") -> str:
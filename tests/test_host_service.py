@@ -0,0 +1,124 @@
+from pathlib import Path
+from subprocess import CompletedProcess
+from types import SimpleNamespace
+
+import pytest
+
+import host_service
+from host_service import LinuxScreenService, ScreenPlatformService, ScreenService, command_argv, default_socket_dir
+
+
+LIST_OUTPUT = "There is a screen on:\n\t1234.mcm-server\t(Detached)\n1 Socket in /run/screen/S-user.\n"
+
+
+def test_unreadable_socket_dir_falls_back_to_screen_list(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    not_a_dir = tmp_path.joinpath("screens")
+    not_a_dir.touch()
+    monkeypatch.setenv("SCREENDIR", str(not_a_dir))
+    monkeypatch.setattr(host_service, "run", lambda cmd, **kwargs: CompletedProcess(cmd, 0, LIST_OUTPUT, ""))
+
+    assert LinuxScreenService().list(trim_id=True) == ["mcm-server"]
+
+
+def test_default_socket_dir_without_passwd_entry(monkeypatch: pytest.MonkeyPatch):
+    def getpwuid(uid: int):
+        raise KeyError(uid)
+    monkeypatch.setattr(host_service.pwd, "getpwuid", getpwuid)
+
+    assert default_socket_dir() is None
+
+
+@pytest.fixture
+def java_installed(monkeypatch: pytest.MonkeyPatch):
+    # Only java is a program, whatever the test machine has on its PATH
+    monkeypatch.setattr(host_service.shutil, "which", lambda name: "/usr/bin/java" if name == "java" else None)
+
+
+@pytest.mark.parametrize("command, argv", [
+    ("java -jar server.jar nogui", ["java", "-jar", "server.jar", "nogui"]),
+    ("java -Xmx4G -jar 'my server.jar'", ["java", "-Xmx4G", "-jar", "my server.jar"]),
+    ('./run.sh "--world name"', ["./run.sh", "--world name"]),
+])
+def test_command_argv_splits_plain_commands(command: str, argv: list[str], java_installed: None):
+    assert command_argv(command) == argv
+
+
+@pytest.mark.parametrize("command", [
+    "./update.sh && java -jar server.jar",
+    "java -Xmx$MEMORY -jar server.jar",
+    "java -jar server.jar > server.log",
+    "java -jar server.jar < input",
+    'java -jar "my\\"server.jar"',
+    "java -jar server.jar\necho done",
+    "JAVA_OPTS=-Xmx4G ./run.sh",
+    "java -jar 'unbalanced.jar",
+    "",
+    "exec java -jar server.jar nogui",
+    "ulimit -n 4096",
+    ". ./env",
+    "time java -jar server.jar",
+])
+def test_command_argv_runs_shell_syntax_through_bash(command: str, java_installed: None):
+    assert command_argv(command) == ["bash", "-c", command]
+
+
+def test_trim_id_keeps_dots_in_session_name():
+    service = LinuxScreenService()
+    assert service.trim_id("1234.1.21 server") == "1.21 server"
+    assert service.trim_id("1234.mcm-server") == "mcm-server"
+    assert service.trim_id("no-pid.server") == "no-pid.server"
+
+
+class FakeScreen(ScreenService):
+    # Records every call instead of talking to screen
+    def __init__(self):
+        self.calls: list[tuple] = []
+
+    def list(self, trim_id: bool = False) -> list[str]:
+        return []
+
+    def create(self, name: str, command: str, workdir: str | None = None) -> bool:
+        self.calls.append(("create", name, command))
+        return True
+
+    def stuff(self, name: str, command: str) -> bool:
+        self.calls.append(("stuff", name, command))
+        return True
+
+    def wait_term(self, name: str, poll_interval: float = 0.5, timeout: float | None = None) -> bool:
+        self.calls.append(("wait_term", name, timeout))
+        return True
+
+
+def test_run_in_server_sends_commands_in_one_stuff():
+    screen = FakeScreen()
+    service = ScreenPlatformService(screen)
+
+    service.run_in_server("survival", ["say bye", "save-all"])
+    service.run_in_server("survival", [])
+
+    assert screen.calls == [("stuff", "mcm-survival", "say bye\nsave-all")]
+
+
+def test_stop_servers_stops_all_before_waiting(monkeypatch: pytest.MonkeyPatch):
+    now = [100.0]
+    monkeypatch.setattr(host_service, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    class SlowScreen(FakeScreen):
+        def wait_term(self, name: str, poll_interval: float = 0.5, timeout: float | None = None) -> bool:
+            now[0] += 3 # every server takes a while to shut down
+            return super().wait_term(name, poll_interval, timeout)
+
+    screen = SlowScreen()
+    result = ScreenPlatformService(screen).stop_servers(["a", "b", "c"])
+
+    assert result == {"a": True, "b": True, "c": True}
+    assert screen.calls == [
+        ("stuff", "mcm-a", "stop"),
+        ("stuff", "mcm-b", "stop"),
+        ("stuff", "mcm-c", "stop"),
+        # One shared deadline, later waits only get what's left of it
+        ("wait_term", "mcm-a", host_service.STOP_TIMEOUT),
+        ("wait_term", "mcm-b", host_service.STOP_TIMEOUT - 3),
+        ("wait_term", "mcm-c", host_service.STOP_TIMEOUT - 6),
+    ]
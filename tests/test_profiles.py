@@ -1,8 +1,11 @@
 
+import os
+from pathlib import Path
 from pydantic import ValidationError
+import pytest
 import yaml
 
-from profiles import Profile
+from profiles import FileProfileRepository, Profile, parse_path
 
 
 def test_hello():
@@ -18,4 +21,134 @@ def test_hello():
         profile = Profile(**loaded)
         print(profile)
     except ValidationError as e:
-        print(e)
\ No newline at end of file
+        print(e)
+
+def test_parse_path_keeps_symlinks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    target = tmp_path / "data"
+    target.mkdir()
+    tmp_path.joinpath("link").symlink_to(target)
+    monkeypatch.chdir(tmp_path)
+
+    assert parse_path("link/world") == tmp_path / "link" / "world"
+    assert parse_path("~/server") == Path.home() / "server"
+
+
+def make_profile(name: str, tmp_path: Path) -> Profile:
+    return Profile(
+        name=name,
+        server_location=tmp_path / "server",
+        backup_location=tmp_path / "backups",
+        server_version="1.21.10-vanilla",
+        entrypoint="java -jar server.jar nogui",
+    )
+
+
+def test_repository_round_trip(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    profile = make_profile("My Server", tmp_path)
+    repo.save(profile.name, profile)
+
+    assert repo.exists("My Server")
+    assert not repo.exists("Other")
+    assert repo.load("My Server") == profile
+    assert [info.profile for info in repo.list()] == [profile]
+
+
+def test_repository_reloads_changed_file(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    location = Path(repo.save("server", make_profile("server", tmp_path)))
+    assert repo.load("server").server_version == "1.21.10-vanilla"
+
+    # Written behind the first repository's back, so its cache is stale
+    changed = make_profile("server", tmp_path).model_copy(update={"server_version": "1.20.4-fabric"})
+    FileProfileRepository(tmp_path).save("server", changed)
+    os.utime(location, ns=(0, 0)) # mtime granularity may hide the rewrite
+
+    assert repo.load("server").server_version == "1.20.4-fabric"
+
+
+def test_repository_caches_unchanged_file(tmp_path: Path):
+    FileProfileRepository(tmp_path).save("server", make_profile("server", tmp_path))
+    repo = FileProfileRepository(tmp_path)
+
+    # Parsed once, every later load hands out the same instance
+    assert repo.load("server") is repo.load("server")
+    assert repo.list()[0].profile is repo.load("server")
+
+
+def test_repository_reads_legacy_yaml(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    profile = make_profile("legacy", tmp_path)
+    tmp_path.joinpath("legacy.yml").write_text(yaml.safe_dump(profile.as_dict()))
+
+    assert repo.load("legacy") == profile
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["legacy.json"]
+
+
+def test_repository_keeps_legacy_yaml_when_json_is_taken(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    other = make_profile("Server", tmp_path)
+    repo.save(other.name, other)
+    legacy = make_profile("server", tmp_path)
+    tmp_path.joinpath("server.yml").write_text(yaml.safe_dump(legacy.as_dict()))
+
+    assert repo.load("server") == legacy
+    assert repo.load("Server") == other
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["server.json", "server.yml"]
+
+    # Saving the other profile again leaves the legacy one alone too
+    repo.save(other.name, other)
+    assert FileProfileRepository(tmp_path).load("server") == legacy
+
+
+def test_repository_lists_invalid_files(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    profile = make_profile("My Server", tmp_path)
+    repo.save(profile.name, profile)
+    tmp_path.joinpath("broken.json").write_text("{")
+
+    listed = sorted(repo.list(), key=lambda info: info.location)
+    assert [(info.location, info.profile) for info in listed] == [("broken.json", None), ("my_server.json", profile)]
+
+
+def test_repository_slots(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    repo.save("Server", make_profile("Server", tmp_path))
+    repo.save("server-1", make_profile("server-1", tmp_path))
+    tmp_path.joinpath("broken.json").write_text("{")
+
+    # Taken files, not profile names, "Server-1" would overwrite server-1.json
+    assert repo.slots() == {"server", "server-1", "broken"}
+
+
+def test_repository_creates_directory_on_save(tmp_path: Path):
+    storage = tmp_path / "profiles"
+    repo = FileProfileRepository(storage)
+    assert repo.list() == []
+    assert not storage.exists()
+
+    repo.save("server", make_profile("server", tmp_path))
+    assert repo.slots() == {"server"}
+
+
+def test_repository_rejects_file_as_storage(tmp_path: Path):
+    storage = tmp_path / "profiles"
+    storage.write_text("")
+    repo = FileProfileRepository(storage)
+
+    with pytest.raises(RuntimeError, match="is not a directory"):
+        repo.list()
+    with pytest.raises(RuntimeError, match="is not a directory"):
+        repo.load("server")
+    with pytest.raises(RuntimeError, match="is not a directory"):
+        repo.save("server", make_profile("server", tmp_path))
+
+
+def test_repository_finds_renamed_file(tmp_path: Path):
+    repo = FileProfileRepository(tmp_path)
+    profile = make_profile("server", tmp_path)
+    Path(repo.save("server", profile)).rename(tmp_path / "copy.json")
+
+    assert FileProfileRepository(tmp_path).load("server") == profile
+    assert FileProfileRepository(tmp_path).load("server") == profile # through the index
+    assert [info.location for info in repo.list()] == ["copy.json"]
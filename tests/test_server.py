@@ -0,0 +1,110 @@
+import gzip
+import os
+import tarfile
+import zlib
+from pathlib import Path
+
+import pytest
+
+from cli import server
+from cli.server import archive_entries, compress_threads, write_tar
+
+
+@pytest.mark.parametrize("value", ["", "many", "0", "-2"])
+def test_compress_threads_ignores_invalid_values(value: str, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("MCM_COMPRESS_THREADS", value)
+    assert compress_threads() >= 1
+
+
+def test_compress_threads_from_environment(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("MCM_COMPRESS_THREADS", "3")
+    assert compress_threads() == 3
+
+
+def make_tree(tmp_path: Path) -> Path:
+    root = tmp_path / "server"
+    root.joinpath("world", "region").mkdir(parents=True)
+    root.joinpath("server.properties").write_text("motd=test\n")
+    # Larger than a compression block, so the archive spans several gzip members
+    root.joinpath("world", "region", "r.0.0.mca").write_bytes(os.urandom(5 << 19))
+    root.joinpath("world", "level.dat").write_bytes(b"\0" * 1000)
+    root.joinpath("latest.log").symlink_to("server.properties")
+    return root
+
+
+def read_members(path: Path) -> dict[str, bytes | str]:
+    members: dict[str, bytes | str] = {}
+    with tarfile.open(path, "r:gz") as tar:
+        for member in tar:
+            if member.issym():
+                members[member.name] = member.linkname
+            else:
+                file = tar.extractfile(member)
+                assert file is not None
+                members[member.name] = file.read()
+    return members
+
+
+@pytest.mark.parametrize("threads", ["1", "3"])
+def test_in_process_gzip_round_trip(threads: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("MCM_COMPRESS_THREADS", threads)
+    monkeypatch.setattr(server, "compressor_command", lambda compression, level: None) # no pigz
+    root = make_tree(tmp_path)
+    archive = tmp_path / "backup.tar.gz"
+
+    with open(archive, "wb") as output:
+        write_tar(archive_entries(root), output, "gz", 1)
+
+    assert read_members(archive) == {
+        "server/server.properties": b"motd=test\n",
+        "server/world/region/r.0.0.mca": root.joinpath("world", "region", "r.0.0.mca").read_bytes(),
+        "server/world/level.dat": b"\0" * 1000,
+        "server/latest.log": "server.properties",
+    }
+
+
+def test_block_index_points_at_independent_members(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("MCM_COMPRESS_THREADS", "2")
+    root = make_tree(tmp_path)
+    archive = tmp_path / "backup.tar.gz"
+    index = tmp_path / "backup.tar.gz.idx"
+
+    with open(archive, "wb") as output:
+        write_tar(archive_entries(root), output, "gz", 1, str(index))
+
+    compressed = archive.read_bytes()
+    uncompressed = gzip.decompress(compressed)
+    offsets = [tuple(map(int, line.split())) for line in index.read_text().splitlines()]
+    assert len(offsets) > 1
+    assert offsets[0] == (0, 0)
+
+    # Every member decompresses on its own into its slice of the tar stream
+    end = 0
+    for uncompressed_offset, compressed_offset in offsets:
+        decompressor = zlib.decompressobj(wbits=31)
+        block = decompressor.decompress(compressed[compressed_offset:])
+        assert decompressor.eof
+        assert block == uncompressed[uncompressed_offset:uncompressed_offset + len(block)]
+        end = uncompressed_offset + len(block)
+    assert end == len(uncompressed)
+    assert set(read_members(archive)) == {
+        "server/server.properties", "server/world/region/r.0.0.mca", "server/world/level.dat", "server/latest.log",
+    }
+
+
+def test_hardlinks_are_stored_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("MCM_COMPRESS_THREADS", "1")
+    monkeypatch.setattr(server, "compressor_command", lambda compression, level: None)
+    root = tmp_path / "server"
+    root.mkdir()
+    root.joinpath("a.dat").write_bytes(b"data" * 100)
+    os.link(root / "a.dat", root / "b.dat")
+    archive = tmp_path / "backup.tar.gz"
+
+    with open(archive, "wb") as output:
+        write_tar(archive_entries(root), output, "gz", 1)
+
+    with tarfile.open(archive, "r:gz") as tar:
+        members = tar.getmembers()
+    assert sorted(member.type for member in members) == sorted([tarfile.REGTYPE, tarfile.LNKTYPE])
+    assert sum(member.size for member in members) == 400
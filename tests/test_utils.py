@@ -0,0 +1,19 @@
+from pathlib import Path
+
+from utils import open_unique_file, sanitize_filename
+
+
+def test_sanitize_filename():
+    assert sanitize_filename("My Server ") == "my_server"
+    assert sanitize_filename(' a<>b:"c ') == "a_b_c"
+    assert sanitize_filename("x\t y") == "x_y"
+
+
+def test_open_unique_file(tmp_path: Path):
+    with open_unique_file(tmp_path, lambda: "backup", ".tar.gz") as first:
+        pass
+    with open_unique_file(tmp_path, lambda: "backup", "tar.gz") as second:
+        pass
+
+    assert Path(first.name).name == "backup.tar.gz"
+    assert Path(second.name).name == "backup-1.tar.gz"